@@ -93,24 +93,45 @@ const ChatWidget = () => {
         throw new Error(`HTTP error! status: ${response.status}`)
       }
 
-      // Parse JSON response from server
-      const data = await response.json()
-      // Log successful response for debugging
-      console.log('Success:', data)
-      
-      // Create message object for AI agent's response
-      const agentResponse = {
-        text: data.response,    // AI's response text
-        isAgent: true,          // Flag indicating this is from AI agent
-        threadId: data.threadId // Thread ID for conversation continuity
+      // Add an empty AI message that fills in as tokens stream in
+      setMessages(prevMessages => [...prevMessages, { text: '', isAgent: true }])
+
+      // Append streamed text to the last (AI) message
+      const appendToAgentMessage = (text) => {
+        setMessages(prevMessages => {
+          const lastMessage = prevMessages[prevMessages.length - 1]
+          return [...prevMessages.slice(0, -1), { ...lastMessage, text: lastMessage.text + text }]
+        })
+      }
+
+      // Read the Server-Sent Events stream frame by frame
+      const reader = response.body.getReader()
+      const decoder = new TextDecoder()
+      let buffer = ''
+
+      while (true) {
+        const { done, value } = await reader.read()
+        if (done) break
+        buffer += decoder.decode(value, { stream: true })
+
+        // Frames are separated by a blank line; keep any partial frame in the buffer
+        const frames = buffer.split('\n\n')
+        buffer = frames.pop()
+
+        for (const frame of frames) {
+          const event = frame.match(/^event: (.*)$/m)?.[1]
+          const data = JSON.parse(frame.match(/^data: (.*)$/m)?.[1] || '{}')
+
+          if (event === 'thread') {
+            // Update thread ID for future messages in this conversation
+            setThreadId(data.threadId)
+          } else if (event === 'token') {
+            appendToAgentMessage(data.content)
+          } else if (event === 'error') {
+            throw new Error(data.error)
+          }
+        }
       }
-      
-      // Add AI response to messages array
-      setMessages(prevMessages => [...prevMessages, agentResponse])
-      // Update thread ID for future messages in this conversation
-      setThreadId(data.threadId)
-      // Log updated messages for debugging
-      console.log(messages)
     } catch (error) {
       // Log any errors that occur during API call
       console.error('Error:', error)
@@ -1,37 +1,266 @@
 # agent.py
 import os
-import json
 import asyncio
+import hashlib
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional, Any, Sequence
-from dataclasses import dataclass
-from pymongo import MongoClient
+import random
+import re
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Any, Sequence, Tuple
 # LangChain imports
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage, message_chunk_to_message
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import tool
-from langchain_mongodb import MongoDBAtlasVectorSearch
 from langgraph.graph import StateGraph
 from langgraph.graph.message import add_messages
 from langgraph.prebuilt import ToolNode
-from langgraph.checkpoint.mongodb import MongoDBSaver
 
 # MongoDB imports
-from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo.errors import PyMongoError
-import ssl
-import certifi
+from bson import ObjectId
+from pymongo import AsyncMongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Shared check for Gemini rate limit errors
+from rate_limits import is_rate_limit_error
+
+# Fast JSON serialization for tool output
+import orjson
 
 # Pydantic for data validation
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from typing_extensions import TypedDict, Annotated
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Database configuration
+DB_NAME = "inventory_database"                  # Name of the MongoDB database
+VECTOR_INDEX = "vector_index"                   # Name of the vector search index on items
+VECTOR_CANDIDATES_PER_RESULT = 10               # HNSW candidates per requested result, offsets quantization recall loss
+# Keywords that imply a category, with the category tags they map to
+CATEGORY_KEYWORDS = [
+    (re.compile(r"\b(sofas?|couch(es)?|sectionals?|loveseats?)\b", re.I), ["Sofa", "Sofas", "Couch", "Living Room"]),
+    (re.compile(r"\b(chairs?|armchairs?|recliners?|stools?)\b", re.I), ["Chair", "Chairs", "Seating"]),
+    (re.compile(r"\b(tables?|desks?)\b", re.I), ["Table", "Tables", "Desk", "Desks"]),
+    (re.compile(r"\b(beds?|mattress(es)?|headboards?)\b", re.I), ["Bed", "Beds", "Bedroom"]),
+    (re.compile(r"\b(lamps?|lighting)\b", re.I), ["Lamp", "Lamps", "Lighting"]),
+    (re.compile(r"\b(shel(f|ves)|bookcases?|bookshelf|bookshelves|cabinets?|dressers?|storage)\b", re.I), ["Storage", "Shelf", "Shelves", "Bookcase"]),
+    (re.compile(r"\b(outdoor|patio|garden)\b", re.I), ["Outdoor", "Patio", "Garden"]),
+]
+# Upper price bound such as "under $500" or "less than 1,200 dollars"; the amount must be marked
+# as money, and "$60 inches"-style sizes are rejected, so "seats up to 6" doesn't become a price
+_PRICE_AMOUNT = r"(\d[\d,]*(?:\.\d+)?)(?!\d|[.,]\d)"
+_NOT_A_UNIT = r"(?!\s*(?:inch(?:es)?|in\b|cm|mm|meters?|ft|feet|foot|lbs?|pounds|kg|seats?|people|persons|guests)\b)"
+PRICE_MAX_PATTERN = re.compile(
+    r"\b(?:under|below|less than|cheaper than|up to|max(?:imum)?)\s*"
+    r"(?:\$\s*" + _PRICE_AMOUNT + _NOT_A_UNIT + r"|" + _PRICE_AMOUNT + r"\s*(?:dollars|usd|bucks)\b)",
+    re.I
+)
+SEARCH_INDEX = "search_index"                   # Name of the Atlas Search (full-text) index on items
+SEARCH_FIELDS = ["item_name", "item_description", "brand", "categories"]  # Fields matched by Atlas Search
+RRF_K = 60                                      # Reciprocal rank fusion damping constant
+VECTOR_WEIGHT = 0.6                             # Share of the fused score from vector search
+TEXT_WEIGHT = 0.4                               # Share of the fused score from full-text search
+TEXT_INDEX = "text_index"                       # Name of the full-text index on items
+MIN_TEXT_SEARCH_LENGTH = 3                      # Shorter queries use a regex instead of the text index
+EMBEDDING_CACHE_SIZE = 1024                     # Query embeddings kept in memory
+EMBED_MAX_BATCH = 64                            # Most query embeddings sent in one Gemini request
+EMBED_MAX_WAIT_SECONDS = 0.01                   # How long a batch waits for more queries
+EMBED_QUEUE_SIZE = 1024                         # Pending query embeddings before callers wait
+RESULT_PROJECTION = {"embedding": 0}            # Search results never need the raw vectors
+MAX_TEXT_FIELD_CHARS = 400                      # Long text fields are cut to this length for the LLM
+
+# Gemini rate limit handling
+GEMINI_CHAT_CONCURRENCY = 10                    # Concurrent Gemini chat calls allowed across all server workers
+GEMINI_EMBED_CONCURRENCY = 20                   # Concurrent Gemini embedding calls allowed across all server workers
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))  # Number of server worker processes sharing those limits
+MAX_RETRY_DELAY_SECONDS = 30                    # Longest wait before retrying a rate-limited call
+
+# Semantic cache configuration
+SEMANTIC_CACHE_COLLECTION = "semantic_cache"    # Collection holding cached agent responses
+SEMANTIC_CACHE_INDEX = "vector_index"           # Name of the vector search index on the cache
+SEMANTIC_CACHE_THRESHOLD = 0.92                 # Minimum cosine similarity for a cache hit
+SEMANTIC_CACHE_TTL_SECONDS = 24 * 60 * 60       # Cached responses expire after 24 hours
+
+# System prompt that defines the AI's role and behavior
+SYSTEM_PROMPT = """You are a helpful E-commerce Chatbot Agent for a furniture store.
+
+    IMPORTANT: You have access to an item_lookup tool that searches the furniture inventory database. ALWAYS use this tool when customers ask about furniture items, even if the tool returns errors or empty results.
+
+    When using the item_lookup tool:
+    - If it returns results, provide helpful details about the furniture items
+    - If it returns an error or no results, acknowledge this and offer to help in other ways
+    - If the database appears to be empty, let the customer know that inventory might be being updated"""
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent embedding requests into batched Gemini calls
+
+    Callers await embed() for a single text; a background task collects up
+    to max_batch texts (waiting at most max_wait seconds for more to arrive)
+    and embeds them with one request.
+    """
+
+    def __init__(self, embed_batch, max_batch: int = EMBED_MAX_BATCH, max_wait: float = EMBED_MAX_WAIT_SECONDS):
+        self.embed_batch = embed_batch          # async function: list of texts -> list of vectors
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=EMBED_QUEUE_SIZE)
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()            # Batches currently being embedded
+
+    async def embed(self, text: str) -> List[float]:
+        """Embed one text as part of the next batch"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[str, asyncio.Future]]:
+        # Block for the first item, then gather more until the batch is full or time runs out
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            # Keep collecting the next batch while this one is being embedded
+            task = asyncio.create_task(self._embed(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _embed(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        try:
+            vectors = await self.embed_batch([text for text, _ in batch])
+            if len(vectors) != len(batch):
+                # Can't tell which text each vector belongs to, so fail the whole batch
+                raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+        except asyncio.CancelledError:
+            for _, future in batch:
+                future.cancel()
+            raise
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():  # The caller may have been cancelled
+                future.set_result(vector)
+
+    async def close(self) -> None:
+        """Stop the batching loop, cancel batches in flight and fail queued requests"""
+        tasks = [task for task in (self._worker, *self._in_flight) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker = None
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            future.cancel()
+
+class CachedEmbeddings(GoogleGenerativeAIEmbeddings):
+    """
+    Gemini embeddings with an in-memory LRU cache for query embeddings
+
+    Repeated queries are answered from memory instead of making another
+    embedding request to Gemini, and async cache misses from concurrent
+    requests are batched into a single request.
+    """
+    cache_size: int = EMBEDDING_CACHE_SIZE
+    _cache: "OrderedDict[str, List[float]]" = PrivateAttr(default_factory=OrderedDict)
+    _batcher: Optional[EmbeddingBatcher] = PrivateAttr(default=None)
+
+    async def _aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        # Batched calls go through the documents endpoint, so ask for query embeddings explicitly
+        async with _GEMINI_EMBED_SEM:
+            return await self.aembed_documents(texts, task_type="retrieval_query")
+
+    def _cache_get(self, key: str) -> Optional[List[float]]:
+        vector = self._cache.get(key)
+        if vector is not None:
+            self._cache.move_to_end(key)  # Mark as most recently used
+        return vector
+
+    def _cache_put(self, key: str, vector: List[float]) -> None:
+        self._cache[key] = vector
+        self._cache.move_to_end(key)
+        # Evict least recently used entries beyond the cache size
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def embed_query(self, text: str, **kwargs: Any) -> List[float]:
+        # Extra options change the embedding, so only plain calls are cached
+        if kwargs:
+            return super().embed_query(text, **kwargs)
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        vector = self._cache_get(key)
+        if vector is None:
+            vector = super().embed_query(text)
+            self._cache_put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str, **kwargs: Any) -> List[float]:
+        if kwargs:
+            return await super().aembed_query(text, **kwargs)
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        vector = self._cache_get(key)
+        if vector is None:
+            if self._batcher is None:
+                self._batcher = EmbeddingBatcher(self._aembed_queries)
+            vector = await self._batcher.embed(text)
+            self._cache_put(key, vector)
+        return vector
+
+    async def aclose(self) -> None:
+        """Shut down the query batcher, if one was started"""
+        if self._batcher is not None:
+            await self._batcher.close()
+            self._batcher = None
+
+# Structured prompt template, built once at import
+PROMPT = ChatPromptTemplate.from_messages([
+    (
+        "system",  # System message defines the AI's role and behavior
+        SYSTEM_PROMPT + """
+
+    Current time: {current_time}""",
+    ),
+    MessagesPlaceholder("messages"),  # Placeholder for conversation history
+])
+
+def _now_iso() -> str:
+    """
+    Current time for the system prompt, at one-second resolution
+
+    Dropping the microseconds keeps the system message byte-identical for
+    back-to-back calls within the same second, so provider-side prompt
+    caching can reuse it.
+    """
+    return datetime.now().replace(microsecond=0).isoformat()
+
+# Google Gemini embedding model, shared across requests instead of rebuilt per call
+embeddings = CachedEmbeddings(
+    google_api_key=os.getenv("GOOGLE_API_KEY"),  # Google API key from environment
+    model="text-embedding-004",                   # Gemini embedding model (768 dimensions)
+)
+
 # Type definitions for better code organization
 class ItemLookupInput(BaseModel):
     query: str = Field(description="The search query")
@@ -50,6 +279,35 @@ class SearchResult(BaseModel):
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
 
+# Cap concurrent Gemini calls across all requests, so bursts queue locally instead of hitting 429s;
+# each worker process gets its share of the limits (main.py never starts more workers than
+# GEMINI_CHAT_CONCURRENCY, so every worker's share is at least one call)
+_GEMINI_CHAT_SEM = asyncio.Semaphore(max(1, GEMINI_CHAT_CONCURRENCY // WEB_CONCURRENCY))
+_GEMINI_EMBED_SEM = asyncio.Semaphore(max(1, GEMINI_EMBED_CONCURRENCY // WEB_CONCURRENCY))
+
+# Items collection for the request being handled, set by call_agent before running the workflow
+_CURRENT_COLLECTION: ContextVar = ContextVar("current_collection")
+
+# Read the delay a rate-limited API asked us to wait, if any
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Extract a Retry-After delay from a rate limit error
+
+    Args:
+        error: Exception raised by the API client
+
+    Returns:
+        Delay in seconds, or None if the error doesn't carry one
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+    try:
+        return float(retry_after) if retry_after is not None else None
+    except (TypeError, ValueError):
+        return None  # HTTP-date values fall back to our own backoff
+
 # Utility function to handle API rate limits with exponential backoff
 async def retry_with_backoff(func, max_retries: int = 3):
     """
@@ -68,10 +326,15 @@ async def retry_with_backoff(func, max_retries: int = 3):
             return await func()  # Try to execute the function
         except Exception as error:
             # Check if it's a rate limit error (HTTP 429) and we have retries left
-            if hasattr(error, 'status_code') and error.status_code == 429 and attempt < max_retries:
-                # Calculate exponential backoff delay: 2^attempt seconds, max 30 seconds
-                delay = min(2 ** attempt, 30)
-                logger.info(f"Rate limit hit. Retrying in {delay} seconds...")
+            if is_rate_limit_error(error) and attempt < max_retries:
+                # Prefer the server's own Retry-After hint when it gives one
+                delay = retry_after_seconds(error)
+                if delay is None:
+                    # Exponential backoff with jitter so concurrent requests don't retry in lockstep
+                    delay = min(MAX_RETRY_DELAY_SECONDS, (2 ** attempt) * (0.5 + random.random()))
+                elif delay > MAX_RETRY_DELAY_SECONDS:
+                    raise error  # Not worth holding the request that long
+                logger.info(f"Rate limit hit. Retrying in {delay:.1f} seconds...")
                 # Wait for the calculated delay before retrying
                 await asyncio.sleep(delay)
                 continue  # Go to next iteration (retry)
@@ -79,247 +342,526 @@ async def retry_with_backoff(func, max_retries: int = 3):
     
     raise Exception("Max retries exceeded")  # This should never be reached
 
-# Main function that creates and runs the AI agent
-async def call_agent(client: AsyncIOMotorClient, query: str, thread_id: str) -> str:
+# Open the Gemini connections before the first user request needs them
+async def warm_up_gemini(model) -> None:
     """
-    Main agent function that processes user queries using LangGraph workflow
-    
+    Make one small embedding request and one short chat request so both
+    Gemini clients have a live, authenticated connection when the first
+    chat arrives
+
     Args:
-        client: MongoDB client instance
-        query: User's query/message
-        thread_id: Unique conversation thread identifier
-        
+        model: Chat model used by the agent (see create_model)
+    """
+    async def warm_up(name: str, call) -> None:
+        try:
+            await call()
+            logger.info(f"Gemini {name} connection warmed up")
+        except Exception as error:
+            # Warm-up is best effort; requests will connect on demand
+            logger.warning(f"Gemini {name} warm-up failed: {error}")
+
+    await asyncio.gather(
+        warm_up("embedding", lambda: embeddings.aembed_query("furniture")),
+        warm_up("chat", lambda: model.ainvoke([HumanMessage(content="Hi")])),
+    )
+
+# Full-text index used by the text search fallback
+async def ensure_text_index(collection) -> None:
+    """
+    Create the full-text index on the items collection if it doesn't exist
+
+    Args:
+        collection: MongoDB items collection
+    """
+    try:
+        await collection.create_index(
+            [
+                ("item_name", "text"),
+                ("item_description", "text"),
+                ("categories", "text"),
+                ("embedding_text", "text"),
+            ],
+            name=TEXT_INDEX,
+            default_language="english",
+        )
+    except PyMongoError as error:
+        # A collection can only have one text index; keep serving with whatever exists
+        logger.warning(f"Could not create text index: {error}")
+
+def _json_default(obj: Any) -> Any:
+    """Serialize the BSON types orjson doesn't know about"""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+# Fast JSON encoding for tool output handed to the LLM
+def to_json(payload: Dict[str, Any]) -> str:
+    """Serialize a tool payload to a JSON string with orjson"""
+    return orjson.dumps(payload, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+# Prepare an item document to be handed to the LLM
+def compact_item(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Cap the long text fields of an item document
+
+    Args:
+        doc: Item document as returned by MongoDB
+
     Returns:
-        AI agent's response as string
+        The same document, modified in place
+    """
+    # Long descriptions cost tokens without helping the answer much
+    for field in ("item_description", "embedding_text"):
+        if isinstance(doc.get(field), str) and len(doc[field]) > MAX_TEXT_FIELD_CHARS:
+            doc[field] = doc[field][:MAX_TEXT_FIELD_CHARS] + "..."
+    return doc
+
+# Keyword-based intent detection used to pre-filter vector search (no LLM call)
+def extract_search_filter(query: str) -> Optional[Dict[str, Any]]:
+    """
+    Derive a $vectorSearch filter from category keywords and price limits in a query
+
+    Args:
+        query: The search query, e.g. "leather sofa under $500"
+
+    Returns:
+        Filter on categories and/or sale price, or None if the query implies neither
+    """
+    conditions = []
+
+    # Categories are free-form tags, so match the usual spellings of each implied tag
+    categories = []
+    for pattern, tags in CATEGORY_KEYWORDS:
+        if pattern.search(query):
+            for tag in tags:
+                categories.extend({tag, tag.lower(), tag.title()})
+    if categories:
+        conditions.append({"categories": {"$in": sorted(set(categories))}})
+
+    match = PRICE_MAX_PATTERN.search(query)
+    if match:
+        amount = match.group(1) or match.group(2)  # "$500" or "500 dollars"
+        conditions.append({"prices.sale_price": {"$lte": float(amount.replace(",", ""))}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def _ranked(pipeline: List[Dict[str, Any]], weight: float, score_field: str) -> List[Dict[str, Any]]:
+    """
+    Append stages that turn a ranked result list into weighted reciprocal-rank scores
+
+    Each result ends up as {"doc": <item>, <score_field>: weight / (RRF_K + rank)},
+    with rank starting at 1 for the best match.
+    """
+    return pipeline + [
+        {"$project": RESULT_PROJECTION},    # Leave the raw vectors in Atlas
+        {"$group": {"_id": None, "docs": {"$push": "$$ROOT"}}},
+        {"$unwind": {"path": "$docs", "includeArrayIndex": "rank"}},
+        {"$project": {
+            "_id": 0,
+            "doc": "$docs",
+            score_field: {"$divide": [weight, {"$add": ["$rank", RRF_K + 1]}]},
+        }},
+    ]
+
+def _vector_search_stage(query_vector: List[float], k: int, search_filter: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the $vectorSearch stage for the items vector index"""
+    return {
+        "$vectorSearch": {
+            "index": VECTOR_INDEX,          # Name of the vector search index
+            "path": "embedding",            # Field containing the vector embeddings
+            "queryVector": query_vector,
+            "numCandidates": k * VECTOR_CANDIDATES_PER_RESULT,  # Candidates considered before picking the top k
+            "limit": k,
+            # Pre-filtering prunes the index traversal instead of discarding results afterwards
+            **({"filter": search_filter} if search_filter else {}),
+        }
+    }
+
+def _to_document(doc: Dict[str, Any]) -> Document:
+    """Turn an item from a search pipeline into a LangChain Document"""
+    doc = compact_item(doc)
+    # Field containing the text used for embeddings becomes the page content
+    page_content = doc.pop("embedding_text", "")
+    return Document(page_content=page_content, metadata=doc)
+
+# Semantic-only search over the inventory using a precomputed query embedding
+async def vector_search(
+    collection,
+    query_vector: List[float],
+    k: int = 10,
+    search_filter: Optional[Dict[str, Any]] = None,
+) -> List[Tuple[Document, float]]:
+    """
+    Run $vectorSearch on its own, without the Atlas Search leg
+
+    Args:
+        collection: MongoDB items collection
+        query_vector: Embedding of the search query
+        k: Number of results to return (default 10)
+        search_filter: Optional pre-filter on indexed metadata fields (see extract_search_filter)
+
+    Returns:
+        List of (document, similarity score) pairs, best match first
+    """
+    pipeline = [
+        _vector_search_stage(query_vector, k, search_filter),
+        {"$set": {"score": {"$meta": "vectorSearchScore"}}},
+        {"$project": RESULT_PROJECTION},    # Leave the raw vectors in Atlas
+    ]
+
+    results = []
+    async for doc in await collection.aggregate(pipeline):
+        score = doc.pop("score")
+        results.append((_to_document(doc), score))
+    return results
+
+# Hybrid semantic + keyword search over the inventory using a precomputed query embedding
+async def hybrid_search(
+    collection,
+    query: str,
+    query_vector: List[float],
+    k: int = 10,
+    search_filter: Optional[Dict[str, Any]] = None,
+) -> List[Tuple[Document, float]]:
+    """
+    Run $vectorSearch and Atlas $search in one pipeline and merge them with reciprocal rank fusion
+
+    Vector search handles paraphrases, full-text search nails exact names,
+    brands and IDs; an item ranked well by either comes out near the top.
+
+    Args:
+        collection: MongoDB items collection
+        query: The search query
+        query_vector: Embedding of the search query
+        k: Number of results to return (default 10)
+        search_filter: Optional pre-filter on indexed metadata fields (see extract_search_filter)
+
+    Returns:
+        List of (document, fused relevance score) pairs, best match first
+    """
+    vector_pipeline = _ranked([
+        _vector_search_stage(query_vector, k, search_filter),
+    ], VECTOR_WEIGHT, "vector_score")
+
+    text_pipeline = _ranked([
+        {
+            "$search": {
+                "index": SEARCH_INDEX,          # Name of the Atlas Search (BM25) index
+                "text": {"query": query, "path": SEARCH_FIELDS},
+            }
+        },
+        *([{"$match": search_filter}] if search_filter else []),
+        {"$limit": k},
+    ], TEXT_WEIGHT, "text_score")
+
+    pipeline = vector_pipeline + [
+        {"$unionWith": {"coll": collection.name, "pipeline": text_pipeline}},
+        # Merge items found by both searches and add up their scores
+        {"$group": {
+            "_id": "$doc._id",
+            "doc": {"$first": "$doc"},
+            "vector_score": {"$max": "$vector_score"},
+            "text_score": {"$max": "$text_score"},
+        }},
+        {"$set": {"score": {"$add": [
+            {"$ifNull": ["$vector_score", 0]},
+            {"$ifNull": ["$text_score", 0]},
+        ]}}},
+        {"$sort": {"score": -1}},
+        {"$limit": k},
+    ]
+
+    results = []
+    async for row in await collection.aggregate(pipeline):
+        results.append((_to_document(row["doc"]), row["score"]))
+    return results
+
+# Hybrid search that degrades to vector-only search when the full-text index is unavailable
+async def semantic_search(
+    collection,
+    query: str,
+    query_vector: List[float],
+    k: int = 10,
+    search_filter: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Tuple[Document, float]], str]:
+    """
+    Search the inventory with hybrid_search, falling back to vector_search
+
+    search_index is only created by the seed script, so it may be missing
+    or still building; the vector results are still worth returning then.
+
+    Returns:
+        (results, search type) where search type is "hybrid" or "vector"
     """
     try:
-        # Database configuration
-        db_name = "inventory_database"        # Name of the MongoDB database
-        db = client[db_name]                  # Get database instance
-        collection = db["items"]              # Get the 'items' collection
-
-        # Create a custom tool for searching furniture inventory
-        @tool("item_lookup", args_schema=ItemLookupInput)
-        async def item_lookup_tool(query: str, n: int = 10) -> str:
-            """
-            Gathers furniture item details from the Inventory database
-            
-            Args:
-                query: The search query
-                n: Number of results to return (default 10)
-                
-            Returns:
-                JSON string containing search results or error information
-            """
-            try:
-                logger.info(f"Item lookup tool called with query: {query}")
-
-                # Check if database has any data at all
-                total_count = await collection.count_documents({})
-                logger.info(f"Total documents in collection: {total_count}")
-
-                # Early return if database is empty
-                if total_count == 0:
-                    logger.info("Collection is empty")
-                    return json.dumps({
-                        "error": "No items found in inventory",
-                        "message": "The inventory database appears to be empty",
-                        "count": 0,
-                        "query": query
-                    })
-
-                # Get sample documents for debugging purposes
-                sample_docs = []
-                async for doc in collection.find({}).limit(3):
-                    # Convert ObjectId to string for JSON serialization
-                    if '_id' in doc:
-                        doc['_id'] = str(doc['_id'])
-                    sample_docs.append(doc)
-                logger.info(f"Sample documents: {sample_docs}")
-
-                # Configuration for MongoDB Atlas Vector Search
-                db_config = {
-                    "collection": collection,           # MongoDB collection to search
-                    "index_name": "vector_index",       # Name of the vector search index
-                    "text_key": "embedding_text",       # Field containing the text used for embeddings
-                    "embedding_key": "embedding",       # Field containing the vector embeddings
-                }
+        return await hybrid_search(collection, query, query_vector, k=k, search_filter=search_filter), "hybrid"
+    except OperationFailure as error:
+        logger.warning(f"Hybrid search failed, using vector search only: {error}")
+        return await vector_search(collection, query_vector, k=k, search_filter=search_filter), "vector"
 
-                # Create vector store instance for semantic search using Google Gemini embeddings
-                vector_store = MongoDBAtlasVectorSearch(
-                    embedding=GoogleGenerativeAIEmbeddings(
-                        google_api_key=os.getenv("GOOGLE_API_KEY"),  # Google API key from environment
-                        model="text-embedding-004",                   # Gemini embedding model
-                    ),
-                    **db_config
-                )
+# Custom tool for searching furniture inventory
+@tool("item_lookup", args_schema=ItemLookupInput)
+async def item_lookup_tool(query: str, n: int = 10) -> str:
+    """
+    Gathers furniture item details from the Inventory database
+
+    Args:
+        query: The search query
+        n: Number of results to return (default 10)
+
+    Returns:
+        JSON string containing search results or error information
+    """
+    try:
+        logger.info(f"Item lookup tool called with query: {query}")
+        collection = _CURRENT_COLLECTION.get()  # Items collection for the current request
 
-                logger.info("Performing vector search...")
-                # Perform semantic search using vector embeddings
+        # Inspect the collection only when debugging; these are extra round-trips to Atlas
+        if logger.isEnabledFor(logging.DEBUG):
+            # Count from collection metadata instead of scanning the index
+            total_count = await collection.estimated_document_count()
+            logger.debug(f"Total documents in collection: {total_count}")
+
+            # Get sample documents for debugging purposes
+            sample_docs = []
+            async for doc in collection.find({}).limit(3):
+                sample_docs.append(doc)
+            logger.debug(f"Sample documents: {sample_docs}")
+
+        logger.info("Performing hybrid search...")
+        # Perform semantic + keyword search in a single pipeline
+        try:
+            # Embed once (served from the LRU cache on repeats) and search by vector
+            query_vector = await embeddings.aembed_query(query)
+            search_filter = extract_search_filter(query)
+            result, search_type = [], "hybrid"
+            if search_filter:
                 try:
-                    result = await vector_store.asimilarity_search_with_score(query, k=n)
-                    logger.info(f"Vector search returned {len(result)} results")
-                except Exception as vector_error:
-                    logger.warning(f"Vector search failed: {vector_error}")
-                    result = []
-                
-                # If vector search returns no results, fall back to text search
+                    result, search_type = await semantic_search(collection, query, query_vector, k=n, search_filter=search_filter)
+                except OperationFailure as filter_error:
+                    # Vector indexes built before the filter fields were added reject filtered queries
+                    logger.warning(f"Filtered search failed: {filter_error}")
                 if len(result) == 0:
-                    logger.info("Vector search returned no results, trying text search...")
-                    # MongoDB text search using regular expressions
-                    text_results = []
-                    async for doc in collection.find({
-                        "$or": [  # OR condition - match any of these fields
-                            {"item_name": {"$regex": query, "$options": "i"}},        # Case-insensitive search in item name
-                            {"item_description": {"$regex": query, "$options": "i"}}, # Case-insensitive search in description
-                            {"categories": {"$regex": query, "$options": "i"}},       # Case-insensitive search in categories
-                            {"embedding_text": {"$regex": query, "$options": "i"}}    # Case-insensitive search in embedding text
-                        ]
-                    }).limit(n):
-                        # Convert ObjectId to string for JSON serialization
-                        if '_id' in doc:
-                            doc['_id'] = str(doc['_id'])
-                        text_results.append(doc)
-                    
-                    logger.info(f"Text search returned {len(text_results)} results")
-                    # Return text search results as JSON string
-                    return json.dumps({
-                        "results": text_results,
-                        "searchType": "text",    # Indicate this was a text search
-                        "query": query,
-                        "count": len(text_results)
-                    })
-
-                # Process vector search results
-                processed_results = []
-                for doc, score in result:
-                    doc_dict = doc.dict() if hasattr(doc, 'dict') else {"page_content": str(doc)}
-                    doc_dict['similarity_score'] = float(score)
-                    processed_results.append(doc_dict)
-
-                # Return vector search results as JSON string
-                return json.dumps({
-                    "results": processed_results,
-                    "searchType": "vector",   # Indicate this was a vector search
-                    "query": query,
-                    "count": len(processed_results)
-                })
-                
-            except Exception as error:
-                # Log detailed error information for debugging
-                logger.error(f"Error in item lookup: {error}")
-                logger.error(f"Error details: {type(error).__name__}: {str(error)}")
-                
-                # Return error information as JSON string
-                return json.dumps({
-                    "error": "Failed to search inventory",
-                    "details": str(error),
-                    "query": query,
-                    "count": 0
+                    # The guessed category/price may not match how items are tagged; search everything
+                    logger.info(f"No results with filter {search_filter}, retrying without it")
+            if len(result) == 0:
+                result, search_type = await semantic_search(collection, query, query_vector, k=n)
+            logger.info(f"{search_type.capitalize()} search returned {len(result)} results")
+        except Exception as search_error:
+            logger.warning(f"Hybrid search failed: {search_error}")
+            result = []
+
+        # If Atlas search is unavailable or finds nothing, fall back to the text index
+        if len(result) == 0:
+            logger.info("Hybrid search returned no results, trying text search...")
+            text_results = []
+            if len(query.strip()) >= MIN_TEXT_SEARCH_LENGTH:
+                # MongoDB full-text search backed by the text index, best matches first
+                cursor = collection.find(
+                    {"$text": {"$search": query}},
+                    {**RESULT_PROJECTION, "score": {"$meta": "textScore"}}
+                ).sort([("score", {"$meta": "textScore"})])
+            else:
+                # Very short queries tokenize poorly, so match them as literal substrings
+                pattern = re.escape(query)
+                cursor = collection.find({
+                    "$or": [  # OR condition - match any of these fields
+                        {"item_name": {"$regex": pattern, "$options": "i"}},        # Case-insensitive search in item name
+                        {"item_description": {"$regex": pattern, "$options": "i"}}, # Case-insensitive search in description
+                        {"categories": {"$regex": pattern, "$options": "i"}},       # Case-insensitive search in categories
+                        {"embedding_text": {"$regex": pattern, "$options": "i"}}    # Case-insensitive search in embedding text
+                    ]
+                }, RESULT_PROJECTION)
+            async for doc in cursor.limit(n):
+                text_results.append(compact_item(doc))
+
+            logger.info(f"Text search returned {len(text_results)} results")
+
+            # Nothing matched at all: tell the agent if that's because the inventory is empty
+            if len(text_results) == 0 and await collection.estimated_document_count() == 0:
+                logger.info("Collection is empty")
+                return to_json({
+                    "error": "No items found in inventory",
+                    "message": "The inventory database appears to be empty",
+                    "count": 0,
+                    "query": query
                 })
 
-        # Array of all available tools (just one in this case)
-        tools = [item_lookup_tool]
-        # Create a tool execution node for the workflow
-        tool_node = ToolNode(tools)
-
-        # Initialize the AI model (Google's Gemini)
-        model = ChatGoogleGenerativeAI(
-            model="gemini-1.5-flash",           # Use Gemini 1.5 Flash model
-            temperature=0,                      # Deterministic responses (no randomness)
-            max_retries=0,                      # Disable built-in retries (we handle our own)
-            google_api_key=os.getenv("GOOGLE_API_KEY"),  # Google API key from environment
-        ).bind_tools(tools)                     # Bind our custom tools to the model
-
-        # Decision function: determines next step in the workflow
-        def should_continue(state: AgentState) -> str:
-            """
-            Routing function that determines the next step in the workflow
-            
-            Args:
-                state: Current state containing conversation messages
-                
-            Returns:
-                Next node name ("tools" or "__end__")
-            """
-            messages = state["messages"]                               # Get all messages
-            last_message = messages[-1]                               # Get the most recent message
-
-            # If the AI wants to use tools, go to tools node; otherwise end
-            if hasattr(last_message, 'tool_calls') and last_message.tool_calls:
-                return "tools"  # Route to tool execution
-            return "__end__"    # End the workflow
-
-        # Function that calls the AI model with retry logic
-        async def call_model(state: AgentState) -> Dict[str, List[BaseMessage]]:
-            """
-            Call the AI model with conversation state and retry logic
-            
-            Args:
-                state: Current agent state with conversation history
-                
-            Returns:
-                Updated state with AI model's response
-            """
-            async def _call_model():
-                # Create a structured prompt template
-                prompt = ChatPromptTemplate.from_messages([
-                    (
-                        "system",  # System message defines the AI's role and behavior
-                        f"""You are a helpful E-commerce Chatbot Agent for a furniture store.
+            # Return text search results as JSON string
+            return to_json({
+                "results": text_results,
+                "searchType": "text",    # Indicate this was a text search
+                "query": query,
+                "count": len(text_results)
+            })
 
-    IMPORTANT: You have access to an item_lookup tool that searches the furniture inventory database. ALWAYS use this tool when customers ask about furniture items, even if the tool returns errors or empty results.
+        # Process hybrid search results
+        processed_results = []
+        for doc, score in result:
+            processed_results.append({
+                "page_content": doc.page_content,
+                "metadata": doc.metadata,
+                "relevance_score": float(score)
+            })
 
-    When using the item_lookup tool:
-    - If it returns results, provide helpful details about the furniture items
-    - If it returns an error or no results, acknowledge this and offer to help in other ways
-    - If the database appears to be empty, let the customer know that inventory might be being updated
+        # Return hybrid search results as JSON string
+        return to_json({
+            "results": processed_results,
+            "searchType": search_type,  # "hybrid" vector + text search, or "vector" when Atlas Search is unavailable
+            "query": query,
+            "count": len(processed_results)
+        })
 
-    Current time: {datetime.now().isoformat()}""",
-                    ),
-                    MessagesPlaceholder("messages"),  # Placeholder for conversation history
-                ])
+    except Exception as error:
+        # Log detailed error information for debugging
+        logger.error(f"Error in item lookup: {error}")
+        logger.error(f"Error details: {type(error).__name__}: {str(error)}")
 
-                # Fill in the prompt template with actual values
-                formatted_prompt = await prompt.aformat_messages(
-                    messages=state["messages"]        # All previous messages
-                )
+        # Return error information as JSON string
+        return to_json({
+            "error": "Failed to search inventory",
+            "details": str(error),
+            "query": query,
+            "count": 0
+        })
 
-                # Call the AI model with the formatted prompt
-                result = await model.ainvoke(formatted_prompt)
-                # Return new state with the AI's response added
-                return {"messages": [result]}
+# Array of all available tools (just one in this case)
+tools = [item_lookup_tool]
 
-            return await retry_with_backoff(_call_model)  # Wrap in retry logic
+# Decision function: determines next step in the workflow
+def should_continue(state: AgentState) -> str:
+    """
+    Routing function that determines the next step in the workflow
+    
+    Args:
+        state: Current state containing conversation messages
+        
+    Returns:
+        Next node name ("tools" or "__end__")
+    """
+    messages = state["messages"]                               # Get all messages
+    last_message = messages[-1]                               # Get the most recent message
 
-        # Build the workflow graph
-        workflow = StateGraph(AgentState)
-        workflow.add_node("agent", call_model)                      # Add AI model node
-        workflow.add_node("tools", tool_node)                       # Add tool execution node
-        workflow.set_entry_point("agent")                           # Start workflow at agent
-        workflow.add_conditional_edges("agent", should_continue)    # Agent decides: tools or end
-        workflow.add_edge("tools", "agent")                         # After tools, go back to agent
+    # If the AI wants to use tools, go to tools node; otherwise end
+    if hasattr(last_message, 'tool_calls') and last_message.tool_calls:
+        return "tools"  # Route to tool execution
+    return "__end__"    # End the workflow
 
-        # create a sync client for LangGraph checkpoints
-        sync_client = MongoClient(os.getenv("MONGODB_ATLAS_URI"), tlsCAFile=certifi.where())
+def create_model():
+    """
+    Create the Gemini chat model with the agent's tools bound to it
 
-        checkpointer = MongoDBSaver(
-            client=sync_client,
-            db_name=db_name
+    Returns:
+        Chat model ready to be shared by every request
+    """
+    return ChatGoogleGenerativeAI(
+        model="gemini-1.5-flash",           # Use Gemini 1.5 Flash model
+        temperature=0,                      # Deterministic responses (no randomness)
+        max_retries=0,                      # Disable built-in retries (we handle our own)
+        google_api_key=os.getenv("GOOGLE_API_KEY"),  # Google API key from environment
+    ).bind_tools(tools)                     # Bind our custom tools to the model
+
+def build_graph(model, checkpointer):
+    """
+    Build and compile the agent workflow once so it can be reused across requests
+
+    Args:
+        model: Chat model with tools bound (see create_model)
+        checkpointer: LangGraph checkpointer used to persist conversation threads
+
+    Returns:
+        Compiled LangGraph workflow
+    """
+    # Create a tool execution node for the workflow
+    tool_node = ToolNode(tools)
+
+    # Function that calls the AI model with retry logic
+    async def call_model(state: AgentState) -> Dict[str, List[BaseMessage]]:
+        """
+        Call the AI model with conversation state and retry logic
+        
+        Args:
+            state: Current agent state with conversation history
+            
+        Returns:
+            Updated state with AI model's response
+        """
+        # Fill in the prompt template with actual values
+        formatted_prompt = await PROMPT.aformat_messages(
+            messages=state["messages"],       # All previous messages
+            current_time=_now_iso()
         )
+
+        async def _start_stream():
+            # Open the reply stream and wait for its first chunk; the semaphore queues
+            # calls locally instead of tripping Gemini's rate limit, and is taken per
+            # attempt so requests sleeping in backoff don't hold a slot
+            await _GEMINI_CHAT_SEM.acquire()
+            stream = model.astream(formatted_prompt)
+            try:
+                return stream, await anext(stream, None)
+            except BaseException:
+                try:
+                    await stream.aclose()
+                finally:
+                    _GEMINI_CHAT_SEM.release()
+                raise
+
+        # Stream the AI model's reply so tokens can be forwarded as they arrive.
+        # Retry only until the first chunk arrives: once tokens have reached
+        # the client, restarting the reply would send them twice
+        stream, result = await retry_with_backoff(_start_stream)
+        try:
+            async for chunk in stream:
+                result = chunk if result is None else result + chunk
+        finally:
+            _GEMINI_CHAT_SEM.release()  # Slot taken by the successful _start_stream attempt
+        # Return new state with the AI's complete response added
+        return {"messages": [message_chunk_to_message(result)]}
+
+    # Build the workflow graph
+    workflow = StateGraph(AgentState)
+    workflow.add_node("agent", call_model)                      # Add AI model node
+    workflow.add_node("tools", tool_node)                       # Add tool execution node
+    workflow.set_entry_point("agent")                           # Start workflow at agent
+    workflow.add_conditional_edges("agent", should_continue)    # Agent decides: tools or end
+    workflow.add_edge("tools", "agent")                         # After tools, go back to agent
+
+    # Compile the workflow with state saving
+    return workflow.compile(checkpointer=checkpointer)
+
+def thread_config(thread_id: str) -> Dict[str, Any]:
+    """Workflow config for a conversation thread"""
+    return {
+        "recursion_limit": 15,                      # Prevent infinite loops
+        "configurable": {"thread_id": thread_id}    # Conversation thread identifier
+    }
+
+# Main function that runs the AI agent
+async def call_agent(app_state: Any, query: str, thread_id: str) -> str:
+    """
+    Main agent function that processes user queries using LangGraph workflow
+    
+    Args:
+        app_state: Application state holding the compiled graph and items collection
+        query: User's query/message
+        thread_id: Unique conversation thread identifier
         
-        # Compile the workflow with state saving
-        app = workflow.compile(checkpointer=checkpointer)
+    Returns:
+        AI agent's response as string
+    """
+    try:
+        # Make the items collection available to item_lookup_tool for this request
+        _CURRENT_COLLECTION.set(app_state.collection)
 
         # Execute the workflow
-        final_state = await app.ainvoke(
+        final_state = await app_state.graph.ainvoke(
             {
                 "messages": [HumanMessage(content=query)],  # Start with user's question
             },
-            config={
-                "recursion_limit": 15,                      # Prevent infinite loops
-                "configurable": {"thread_id": thread_id}    # Conversation thread identifier
-            }
+            config=thread_config(thread_id)
         )
 
         # Extract the final response from the conversation
@@ -329,12 +871,269 @@ async def call_agent(client: AsyncIOMotorClient, query: str, thread_id: str) ->
         return response  # Return the AI's final response
 
     except Exception as error:
-        # Handle different types of errors with user-friendly messages
         logger.error(f"Error in call_agent: {error}")
+        raise agent_error(error)
+
+# Streaming variant of call_agent
+async def stream_agent(app_state: Any, query: str, thread_id: str) -> AsyncIterator[str]:
+    """
+    Run the agent workflow and yield the final response as it is generated
+    
+    Args:
+        app_state: Application state holding the compiled graph and items collection
+        query: User's query/message
+        thread_id: Unique conversation thread identifier
         
-        if hasattr(error, 'status_code') and error.status_code == 429:  # Rate limit error
-            raise Exception("Service temporarily unavailable due to rate limits. Please try again in a minute.")
-        elif hasattr(error, 'status_code') and error.status_code == 401:  # Authentication error
-            raise Exception("Authentication failed. Please check your API configuration.")
-        else:  # Generic error
-            raise Exception(f"Agent failed: {str(error)}")
\ No newline at end of file
+    Yields:
+        Pieces of the AI agent's response text
+    """
+    try:
+        # Make the items collection available to item_lookup_tool for this request
+        _CURRENT_COLLECTION.set(app_state.collection)
+
+        # Execute the workflow, forwarding tokens from the agent node as they stream in
+        async for event in app_state.graph.astream_events(
+            {
+                "messages": [HumanMessage(content=query)],  # Start with user's question
+            },
+            config=thread_config(thread_id),
+            version="v2"
+        ):
+            if event["event"] != "on_chat_model_stream":
+                continue
+            chunk = event["data"]["chunk"]
+            # Skip tool-calling turns: only the final answer is meant for the user
+            if getattr(chunk, "tool_call_chunks", None):
+                continue
+            if isinstance(chunk.content, str) and chunk.content:
+                yield chunk.content
+
+    except Exception as error:
+        logger.error(f"Error in stream_agent: {error}")
+        raise agent_error(error)
+
+def agent_error(error: Exception) -> Exception:
+    """Translate an agent failure into an exception with a user-friendly message"""
+    if is_rate_limit_error(error):  # Rate limit error
+        return Exception("Service temporarily unavailable due to rate limits. Please try again in a minute.")
+    elif hasattr(error, 'status_code') and error.status_code == 401:  # Authentication error
+        return Exception("Authentication failed. Please check your API configuration.")
+    else:  # Generic error
+        return Exception(f"Agent failed: {str(error)}")
+
+class SemanticCacheLayer:
+    """
+    Semantic cache in front of call_agent that answers queries similar to
+    ones already answered without running the LangGraph workflow
+
+    Entries are namespaced by a hash of the system prompt, so changing the
+    prompt invalidates everything cached under the previous one.
+    """
+
+    def __init__(
+        self,
+        client: AsyncMongoClient,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds: int = SEMANTIC_CACHE_TTL_SECONDS,
+    ):
+        self.client = client
+        self.collection = client[DB_NAME][SEMANTIC_CACHE_COLLECTION]
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.namespace = hashlib.sha256(SYSTEM_PROMPT.encode("utf-8")).hexdigest()
+
+    async def setup(self) -> None:
+        """Create the TTL index and the vector search index used by the cache"""
+        # Let MongoDB expire stale responses automatically
+        try:
+            try:
+                await self.collection.create_index("ts", expireAfterSeconds=self.ttl_seconds)
+            except OperationFailure as error:
+                if error.code != 85:  # IndexOptionsConflict
+                    raise
+                # The TTL changed since the index was built; update it in place
+                await self.collection.database.command(
+                    "collMod", self.collection.name,
+                    index={"keyPattern": {"ts": 1}, "expireAfterSeconds": self.ttl_seconds}
+                )
+                logger.info(f"Updated semantic cache TTL to {self.ttl_seconds} seconds")
+        except PyMongoError as error:
+            logger.warning(f"Semantic cache TTL index unavailable: {error}")
+
+        try:
+            cursor = await self.collection.list_search_indexes(SEMANTIC_CACHE_INDEX)
+            existing = await cursor.to_list(length=None)
+            if not existing:
+                await self.collection.create_search_index({
+                    "name": SEMANTIC_CACHE_INDEX,
+                    "type": "vectorSearch",
+                    "definition": {
+                        "fields": [
+                            {
+                                "type": "vector",
+                                "path": "embedding",
+                                "numDimensions": 768,
+                                "similarity": "cosine",
+                                "quantization": "scalar"
+                            },
+                            {
+                                "type": "filter",
+                                "path": "namespace"
+                            }
+                        ]
+                    }
+                })
+                logger.info("Created semantic cache vector search index")
+        except PyMongoError as error:
+            logger.warning(f"Semantic cache vector search index unavailable: {error}")
+
+    async def lookup(self, query_vector: List[float]) -> Optional[str]:
+        """
+        Find a cached response for a query embedding
+
+        Args:
+            query_vector: Embedding of the user's query
+
+        Returns:
+            Cached response if a close enough match exists, otherwise None
+        """
+        pipeline = [
+            {
+                "$vectorSearch": {
+                    "index": SEMANTIC_CACHE_INDEX,
+                    "path": "embedding",
+                    "queryVector": query_vector,
+                    "numCandidates": 20,
+                    "limit": 1,
+                    "filter": {"namespace": self.namespace},
+                }
+            },
+            {"$project": {"_id": 0, "response": 1, "score": {"$meta": "vectorSearchScore"}}},
+        ]
+        async for doc in await self.collection.aggregate(pipeline):
+            # Atlas reports cosine similarity normalized to (1 + cosine) / 2
+            similarity = 2 * doc["score"] - 1
+            if similarity >= self.threshold:
+                return doc["response"]
+        return None
+
+    async def store(self, query: str, query_vector: List[float], response: str) -> None:
+        """Save an agent response under the query's embedding"""
+        await self.collection.insert_one({
+            "namespace": self.namespace,
+            "query": query,
+            "embedding": query_vector,
+            "response": response,
+            "ts": datetime.now(timezone.utc),
+        })
+
+    async def _cached_response(self, app_state: Any, query: str, thread_id: str) -> Tuple[Optional[str], Optional[List[float]]]:
+        """
+        Look up a cached response for the first message of a conversation
+
+        On a hit the exchange is recorded in the thread so follow-up messages
+        keep the conversation context.
+
+        Returns:
+            (cached response or None, query embedding or None if the lookup failed)
+        """
+        query_vector = None
+        try:
+            query_vector = await embeddings.aembed_query(query)
+            cached = await self.lookup(query_vector)
+            if cached is not None:
+                logger.info(f"Semantic cache hit for query: {query}")
+                await app_state.graph.aupdate_state(
+                    thread_config(thread_id),
+                    {"messages": [HumanMessage(content=query), AIMessage(content=cached)]},
+                    as_node="agent",
+                )
+            return cached, query_vector
+        except Exception as error:
+            # The cache is an optimization, never a reason to fail the request
+            logger.warning(f"Semantic cache lookup failed: {error}")
+            return None, query_vector
+
+    async def _cacheable_response(self, app_state: Any, thread_id: str) -> Optional[str]:
+        """
+        Read the final response of the turn just run, if it is safe to cache
+
+        Answers built on a failed or empty inventory lookup are not cached,
+        so a temporary outage or an unseeded database isn't replayed for a day.
+
+        Returns:
+            The agent's final response, or None if it shouldn't be cached
+        """
+        snapshot = await app_state.graph.aget_state(thread_config(thread_id))
+        messages = snapshot.values.get("messages", [])
+
+        # Only look at the messages produced after the user's latest question
+        turn_start = max((i for i, message in enumerate(messages) if isinstance(message, HumanMessage)), default=-1)
+        for message in messages[turn_start + 1:]:
+            if isinstance(message, ToolMessage) and message.name == "item_lookup":
+                try:
+                    lookup = orjson.loads(message.content)
+                except (orjson.JSONDecodeError, TypeError):
+                    return None
+                if lookup.get("error") or lookup.get("count", 0) == 0:
+                    return None
+
+        if not messages or not isinstance(messages[-1], AIMessage):
+            return None
+        return messages[-1].content or None
+
+    async def _store_response(self, app_state: Any, query: str, query_vector: Optional[List[float]], thread_id: str) -> None:
+        """Cache the response just generated for a thread, ignoring failures"""
+        if query_vector is None:
+            return
+        try:
+            response = await self._cacheable_response(app_state, thread_id)
+            if response is not None:
+                await self.store(query, query_vector, response)
+        except Exception as error:
+            # The cache is an optimization, never a reason to fail the request
+            logger.warning(f"Failed to store response in semantic cache: {error}")
+
+    async def call_agent(self, app_state: Any, query: str, thread_id: str) -> str:
+        """
+        Answer from the cache when possible, otherwise run the agent and cache its response
+
+        Only meant for the first message of a conversation: follow-up messages
+        depend on thread history that the cache knows nothing about.
+
+        Args:
+            app_state: Application state holding the compiled graph and items collection
+            query: User's query/message
+            thread_id: Unique conversation thread identifier
+
+        Returns:
+            AI agent's response as string
+        """
+        cached, query_vector = await self._cached_response(app_state, query, thread_id)
+        if cached is not None:
+            return cached
+
+        response = await call_agent(app_state, query, thread_id)
+        await self._store_response(app_state, query, query_vector, thread_id)
+        return response
+
+    async def stream_agent(self, app_state: Any, query: str, thread_id: str) -> AsyncIterator[str]:
+        """
+        Streaming variant of call_agent: a cache hit is yielded in one piece
+
+        Args:
+            app_state: Application state holding the compiled graph and items collection
+            query: User's query/message
+            thread_id: Unique conversation thread identifier
+
+        Yields:
+            Pieces of the AI agent's response text
+        """
+        cached, query_vector = await self._cached_response(app_state, query, thread_id)
+        if cached is not None:
+            yield cached
+            return
+
+        async for piece in stream_agent(app_state, query, thread_id):
+            yield piece
+        await self._store_response(app_state, query, query_vector, thread_id)
@@ -1,22 +1,28 @@
 # main.py
 import os
+import json
 import asyncio
 import time
-from typing import Optional
+from typing import AsyncIterator, Optional
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient, MongoClient
+from langgraph.checkpoint.mongodb import MongoDBSaver
 import ssl
 import certifi
 from dotenv import load_dotenv
 
-# Import our custom AI agent function
-from agent import call_agent
-
 # Load environment variables from .env file (must be first)
 load_dotenv()
 
+# Import our custom AI agent functions and its semantic cache
+from agent import (
+    call_agent, stream_agent, create_model, build_graph, ensure_text_index,
+    warm_up_gemini, SemanticCacheLayer, DB_NAME, GEMINI_CHAT_CONCURRENCY, embeddings
+)
+
 # Create FastAPI application instance
 app = FastAPI(title="LangGraph Agent Server")
 
@@ -41,18 +47,21 @@ class ErrorResponse(BaseModel):
     error: str
 
 # Global MongoDB client variable
-mongo_client: Optional[AsyncIOMotorClient] = None
+mongo_client: Optional[AsyncMongoClient] = None
+# Global semantic cache placed in front of the agent
+semantic_cache: Optional[SemanticCacheLayer] = None
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize MongoDB connection when server starts"""
-    global mongo_client
+    global mongo_client, semantic_cache
     try:
         # Create MongoDB client using connection string from environment variables
         # SSL configuration for macOS certificate issues
-        mongo_client = AsyncIOMotorClient(
+        mongo_client = AsyncMongoClient(
             os.getenv("MONGODB_ATLAS_URI"),
-            tlsCAFile=certifi.where()
+            tlsCAFile=certifi.where(),
+            maxPoolSize=100
         )
         
         # Ping MongoDB to verify connection is working
@@ -60,6 +69,32 @@ async def startup_event():
         
         # Log successful connection
         print("You successfully connected to MongoDB!")
+
+        # Build the agent once at startup and share it across requests
+        app.state.collection = mongo_client[DB_NAME]["items"]
+        await ensure_text_index(app.state.collection)
+        # Sync client for LangGraph checkpoints; keeps a few warm sockets for checkpoint writes
+        app.state.sync_client = MongoClient(
+            os.getenv("MONGODB_ATLAS_URI"),
+            tlsCAFile=certifi.where(),
+            maxPoolSize=20,
+            minPoolSize=2,
+            waitQueueTimeoutMS=2000
+        )
+        # MongoDBSaver runs its async checkpoint reads/writes in an executor, off the event loop
+        app.state.checkpointer = MongoDBSaver(
+            client=app.state.sync_client,
+            db_name=DB_NAME
+        )
+        app.state.model = create_model()
+        app.state.graph = build_graph(app.state.model, app.state.checkpointer)
+
+        # Set up the semantic cache collection and its indexes
+        semantic_cache = SemanticCacheLayer(mongo_client)
+        await semantic_cache.setup()
+
+        # Pay the Gemini connection setup cost now rather than on the first chat
+        await warm_up_gemini(app.state.model)
         
     except Exception as error:
         # Handle any errors during MongoDB connection
@@ -71,9 +106,14 @@ async def startup_event():
 async def shutdown_event():
     """Close MongoDB connection when server shuts down"""
     global mongo_client
+    # Stop the embedding batcher before the connections it may be using go away
+    await embeddings.aclose()
     if mongo_client:
-        mongo_client.close()
+        await mongo_client.close()
         print("MongoDB connection closed")
+    sync_client = getattr(app.state, "sync_client", None)
+    if sync_client:
+        sync_client.close()
 
 @app.get("/")
 async def root():
@@ -81,16 +121,42 @@ async def root():
     # Send simple response to confirm server is running
     return {"message": "LangGraph Agent Server"}
 
-@app.post("/chat", response_model=ChatResponse)
-async def start_chat(chat_message: ChatMessage):
-    """Define endpoint for starting new conversations (POST /chat)"""
-    global mongo_client
-    
-    if not mongo_client:
+def sse_frame(event: str, data: dict) -> str:
+    """Format a single Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def ensure_connected(require_cache: bool = False) -> None:
+    """Reject requests until the database connection (and, if needed, the semantic cache) is ready"""
+    if not mongo_client or (require_cache and not semantic_cache):
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Database connection not available"
         )
+
+async def event_stream(response_chunks: AsyncIterator[str], thread_id: str) -> AsyncIterator[str]:
+    """
+    Wrap the agent's streamed response in SSE frames
+
+    The thread ID goes out first so clients can continue the conversation
+    even if generation fails halfway through.
+    """
+    yield sse_frame("thread", {"threadId": thread_id})
+    try:
+        async for chunk in response_chunks:
+            yield sse_frame("token", {"content": chunk})
+        yield sse_frame("done", {})
+    except Exception as error:
+        # Log any errors that occur during agent execution
+        print(f"Error streaming response: {error}")
+        # Headers are already sent, so report the failure in-band
+        yield sse_frame("error", {"error": "Internal server error"})
+
+# Non-streaming endpoints for clients that can't consume SSE
+# (declared before /chat/{thread_id} so "sync" isn't taken for a thread ID)
+@app.post("/chat/sync", response_model=ChatResponse)
+async def start_chat_sync(chat_message: ChatMessage):
+    """Define endpoint for starting new conversations (POST /chat/sync)"""
+    ensure_connected(require_cache=True)
     
     # Extract user message from request body
     initial_message = chat_message.message
@@ -102,8 +168,8 @@ async def start_chat(chat_message: ChatMessage):
     print(f"Initial message: {initial_message}")
     
     try:
-        # Call our AI agent with the message and new thread ID
-        response = await call_agent(mongo_client, initial_message, thread_id)
+        # Call our AI agent (through the semantic cache) with the message and new thread ID
+        response = await semantic_cache.call_agent(app.state, initial_message, thread_id)
         
         # Send successful response with thread ID and AI response
         return ChatResponse(threadId=thread_id, response=response)
@@ -117,23 +183,17 @@ async def start_chat(chat_message: ChatMessage):
             detail="Internal server error"
         )
 
-@app.post("/chat/{thread_id}", response_model=ChatResponse)
-async def continue_chat(thread_id: str, chat_message: ChatMessage):
-    """Define endpoint for continuing existing conversations (POST /chat/:threadId)"""
-    global mongo_client
-    
-    if not mongo_client:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Database connection not available"
-        )
+@app.post("/chat/sync/{thread_id}", response_model=ChatResponse)
+async def continue_chat_sync(thread_id: str, chat_message: ChatMessage):
+    """Define endpoint for continuing existing conversations (POST /chat/sync/:threadId)"""
+    ensure_connected()
     
     # Extract user message from request body
     message = chat_message.message
     
     try:
         # Call AI agent with message and existing thread ID (continues conversation)
-        response = await call_agent(mongo_client, message, thread_id)
+        response = await call_agent(app.state, message, thread_id)
         
         # Send AI response (no need to send threadId again since it's continuing)
         return ChatResponse(response=response)
@@ -147,12 +207,53 @@ async def continue_chat(thread_id: str, chat_message: ChatMessage):
             detail="Internal server error"
         )
 
+@app.post("/chat")
+async def start_chat(chat_message: ChatMessage):
+    """Define streaming endpoint for starting new conversations (POST /chat)"""
+    ensure_connected(require_cache=True)
+    
+    # Generate unique thread ID using current timestamp
+    thread_id = str(int(time.time() * 1000))  # Convert to milliseconds like Date.now()
+    
+    # Log the incoming message for debugging
+    print(f"Initial message: {chat_message.message}")
+    
+    # Stream our AI agent's response (through the semantic cache) as Server-Sent Events
+    return StreamingResponse(
+        event_stream(semantic_cache.stream_agent(app.state, chat_message.message, thread_id), thread_id),
+        media_type="text/event-stream"
+    )
+
+@app.post("/chat/{thread_id}")
+async def continue_chat(thread_id: str, chat_message: ChatMessage):
+    """Define streaming endpoint for continuing existing conversations (POST /chat/:threadId)"""
+    ensure_connected()
+    
+    # Stream AI agent's response for the existing thread as Server-Sent Events
+    return StreamingResponse(
+        event_stream(stream_agent(app.state, chat_message.message, thread_id), thread_id),
+        media_type="text/event-stream"
+    )
+
 if __name__ == "__main__":
     import uvicorn
     
     # Get port from environment variable or default to 8000
     port = int(os.getenv("PORT", 8000))
     
-    # Start the FastAPI server on specified port
+    # One worker process per CPU; each worker opens its own connections in startup_event.
+    # Workers share the Gemini chat limit, so there's no point running more of them than that
+    workers = min(int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)), GEMINI_CHAT_CONCURRENCY)
+    # Workers inherit this, so the agent splits its Gemini concurrency limits between them
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    
+    # Start the FastAPI server on specified port, on the uvloop event loop with the httptools parser
     print(f"Server running on port {port}")
-    uvicorn.run(app, host="localhost", port=port)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",          # Import string is required to run multiple workers
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=workers
+    )
\ No newline at end of file
@@ -0,0 +1,20 @@
+# rate_limits.py
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Check whether a Gemini error means we hit the rate limit (HTTP 429)
+
+    Google API errors expose the status as `code` (ResourceExhausted), while
+    HTTP client errors use `status_code`; both are checked.
+
+    Args:
+        error: Exception raised by the API client
+
+    Returns:
+        True if the error is a rate limit error
+    """
+    return (
+        type(error).__name__ == "ResourceExhausted"
+        or getattr(error, "status_code", None) == 429
+        or getattr(error, "code", None) == 429
+    )
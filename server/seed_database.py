@@ -2,6 +2,7 @@
 
 import os
 import json
+import random
 import asyncio
 from typing import List, Dict, Any
 from datetime import datetime
@@ -12,13 +13,16 @@ from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmb
 from langchain_core.output_parsers import PydanticOutputParser
 # Import MongoDB async client for database connection
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+# Fast JSON parser for the AI responses
+import orjson
 import ssl
 import certifi
-# Import MongoDB Atlas vector search for storing and searching embeddings
-from langchain_mongodb import MongoDBAtlasVectorSearch
 # Import Pydantic for data schema validation and type safety
 from pydantic import BaseModel, Field
 from typing import List as TypingList, Optional
+# Shared check for Gemini rate limit errors
+from rate_limits import is_rate_limit_error
 # Load environment variables from .env file (API keys, connection strings)
 from dotenv import load_dotenv
 
@@ -56,52 +60,134 @@ class Item(BaseModel):
 class ItemList(BaseModel):
     items: TypingList[Item] = Field(description="List of furniture items")
 
-# Create MongoDB client instance using connection string from environment variables
-# SSL configuration for macOS certificate issues
-import ssl
-import certifi
-
-client = AsyncIOMotorClient(
-    os.getenv("MONGODB_ATLAS_URI"),
-    tlsCAFile=certifi.where(),
-
-)
-
-# Initialize Google Gemini chat model for generating synthetic furniture data
-llm = ChatGoogleGenerativeAI(
-    model="gemini-1.5-flash",                    # Use Gemini 1.5 Flash model
-    temperature=0.7,                             # Set creativity level (0.7 = moderately creative)
-    google_api_key=os.getenv("GOOGLE_API_KEY"),  # Google API key from environment variables
-)
-
-# Create parser that ensures AI output matches our item schema
+# Gemini API keys to rotate between (comma-separated GOOGLE_API_KEYS, or the single GOOGLE_API_KEY);
+# each key has its own rate limit, so parallel requests spread across them
+GOOGLE_API_KEYS = [
+    key.strip()
+    for key in (os.getenv("GOOGLE_API_KEYS") or os.getenv("GOOGLE_API_KEY") or "").split(",")
+    if key.strip()
+] or [None]
+
+def create_generation_llms() -> List[Any]:
+    """
+    Create the Gemini chat models used to generate synthetic furniture data
+
+    Generating sample data doesn't need a large model, so this uses Flash-8B,
+    one client per API key in GOOGLE_API_KEYS. With Google Cloud credentials
+    configured (and langchain-google-vertexai installed) it goes through
+    Vertex AI instead, whose rate limit is much higher than AI Studio's; Vertex
+    authenticates with service credentials, so a single model is enough there.
+    """
+    if os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+        try:
+            from langchain_google_vertexai import ChatVertexAI
+            return [ChatVertexAI(
+                model="gemini-1.5-flash-002",            # Gemini 1.5 Flash on Vertex AI
+                temperature=0.7,                         # Set creativity level (0.7 = moderately creative)
+                max_retries=0,                           # Disable built-in retries (with_backoff handles them)
+            )]
+        except ImportError:
+            print("langchain-google-vertexai not installed, using the Gemini API instead")
+    return [
+        ChatGoogleGenerativeAI(
+            model="gemini-1.5-flash-8b",                 # Use the smaller, faster Gemini 1.5 Flash-8B model
+            temperature=0.7,                             # Set creativity level (0.7 = moderately creative)
+            google_api_key=key,                          # Google API key from environment variables
+            max_retries=0,                               # Disable built-in retries (with_backoff handles them)
+        )
+        for key in GOOGLE_API_KEYS
+    ]
+
+# Initialize Google Gemini chat models for generating synthetic furniture data, rotated round-robin
+LLMS = create_generation_llms()
+
+# Initialize Google embedding models once (one per API key) and reuse their HTTP clients for every batch
+EMBEDDERS = [
+    GoogleGenerativeAIEmbeddings(
+        google_api_key=key,                         # Google API key
+        model="text-embedding-004",                 # Google's standard embedding model (768 dimensions)
+    )
+    for key in GOOGLE_API_KEYS
+]
+
+# Maximum number of concurrent Gemini requests while generating data
+GENERATION_CONCURRENCY = 4
+
+# Records embedded and inserted per batch; larger batches show diminishing returns
+EMBED_BATCH = 32
+# Maximum number of embed + insert batches in flight at once
+INSERT_CONCURRENCY = 2
+
+# Parser used to describe our item schema to the AI
 parser = PydanticOutputParser(pydantic_object=ItemList)
-
-async def setup_database_and_collection() -> None:
+# Format instructions are built from the item schema once, not on every prompt
+FORMAT_INSTRUCTIONS = parser.get_format_instructions()
+
+async def with_backoff(coro_factory, retries: int = 3, base: float = 1.0, cap: float = 60.0):
+    """
+    Await a Gemini call, retrying with exponential backoff when rate limited
+
+    Args:
+        coro_factory: Function returning a fresh awaitable for each attempt
+        retries: Maximum number of retries after the first attempt (default 3)
+        base: Initial delay in seconds (default 1)
+        cap: Maximum delay in seconds (default 60)
+
+    Returns:
+        Result of the call
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await coro_factory()
+        except Exception as error:
+            if not is_rate_limit_error(error) or attempt == retries:
+                raise
+            # Exponential delay plus jitter so parallel requests don't retry together
+            delay = min(cap, base * 2 ** attempt) + random.random()
+            print(f"Rate limit hit. Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+async def setup_database_and_collection(client: AsyncIOMotorClient) -> None:
     """Function to create database and collection before seeding"""
     print("Setting up database and collection...")
     
     # Get reference to the inventory_database database
     db = client["inventory_database"]
     
-    # Create the items collection if it doesn't exist
-    collections = await db.list_collection_names()
-    
-    if "items" not in collections:
-        await db.create_collection("items")
+    # Create the items collection without listing the collections first;
+    # the server rejects it if it already exists
+    try:
+        await db.create_collection("items", check_exists=False)
         print("Created 'items' collection in 'inventory_database' database")
-    else:
+    except OperationFailure as error:
+        if error.code != 48:  # NamespaceExists
+            raise
         print("'items' collection already exists in 'inventory_database' database")
 
-async def create_vector_search_index() -> None:
+async def ensure_search_index(collection, index: Dict[str, Any]) -> None:
+    """
+    Create an Atlas Search index, or update it if its definition changed
+
+    Existing indexes are left alone when they already match, so reseeding
+    doesn't trigger a rebuild or a window without an index.
+    """
+    existing = await collection.list_search_indexes(index["name"]).to_list(length=None)
+    if not existing:
+        await collection.create_search_index(index)
+        print(f"Successfully created search index '{index['name']}'")
+    elif existing[0].get("latestDefinition") != index["definition"]:
+        # Atlas builds the new definition in the background and swaps it in when ready
+        await collection.update_search_index(index["name"], index["definition"])
+        print(f"Updated search index '{index['name']}' to the new definition")
+    else:
+        print(f"Search index '{index['name']}' is already up to date")
+
+async def create_vector_search_index(client: AsyncIOMotorClient) -> None:
     """Function to create vector search index"""
     try:
         db = client["inventory_database"]
         collection = db["items"]
         
-        # Drop existing indexes
-        await collection.drop_indexes()
-        
         vector_search_idx = {
             "name": "vector_index",
             "type": "vectorSearch",
@@ -111,97 +197,161 @@ async def create_vector_search_index() -> None:
                         "type": "vector",
                         "path": "embedding",
                         "numDimensions": 768,
-                        "similarity": "cosine"
+                        "similarity": "cosine",
+                        "quantization": "scalar"    # Index int8 vectors; documents keep full precision
+                    },
+                    {
+                        "type": "filter",           # Lets the agent pre-filter by category
+                        "path": "categories"
+                    },
+                    {
+                        "type": "filter",           # Lets the agent pre-filter by price
+                        "path": "prices.sale_price"
                     }
                 ]
             }
         }
         
         print("Creating vector search index...")
-        # Note: In Python, we use create_search_index differently
-        # This might need to be adjusted based on your MongoDB setup
         try:
-            await collection.create_search_index(vector_search_idx)
-            print("Successfully created vector search index")
+            await ensure_search_index(collection, vector_search_idx)
         except Exception as e:
             print(f"Note: Vector search index creation may require MongoDB Atlas setup: {e}")
+
+        # Full-text (BM25) index used alongside vector search for hybrid queries
+        text_search_idx = {
+            "name": "search_index",
+            "type": "search",
+            "definition": {
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "item_name": {"type": "string"},
+                        "item_description": {"type": "string"},
+                        "brand": {"type": "string"},
+                        "categories": {"type": "string"}
+                    }
+                }
+            }
+        }
+
+        print("Creating full-text search index...")
+        try:
+            await ensure_search_index(collection, text_search_idx)
+        except Exception as e:
+            print(f"Note: Full-text search index creation may require MongoDB Atlas setup: {e}")
             
     except Exception as e:
         print(f'Failed to create vector search index: {e}')
 
-async def generate_synthetic_data() -> List[Item]:
-    """Generate synthetic furniture data using AI"""
+def strip_code_fence(text: str) -> str:
+    """Remove the markdown code fence Gemini often wraps its JSON replies in"""
+    text = text.strip()
+    if text.startswith("```"):
+        # Drop the opening fence line (e.g. ```json) and the closing fence
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    return text
+
+async def bootstrap_collection(client: AsyncIOMotorClient) -> None:
+    """
+    Get the collection ready for a fresh seed
+
+    Creates the collection and its search indexes if needed, then clears
+    any existing documents and the agent's cached answers about them. Runs
+    alongside data generation in seed_database().
+    """
+    # Setup database and collection
+    await setup_database_and_collection(client)
+
+    # Create vector search index
+    await create_vector_search_index(client)
+
+    # Clear existing data from collection (fresh start)
+    delete_result = await client["inventory_database"]["items"].delete_many({})
+    print(f"Cleared {delete_result.deleted_count} existing documents from items collection")
+
+    # Cached chat answers describe the old items and prices, so drop them too
+    cache_result = await client["inventory_database"]["semantic_cache"].delete_many({})
+    print(f"Cleared {cache_result.deleted_count} cached responses from semantic_cache collection")
+
+async def generate_synthetic_data(total: int = 10, shards: int = 5) -> List[Item]:
+    """
+    Generate synthetic furniture data using AI
+
+    The items are requested as several smaller prompts running in parallel,
+    so generation takes roughly as long as one short reply instead of one
+    long one, and one malformed reply only loses its own share of items.
+    """
     # Create detailed prompt instructing AI to generate furniture store data
-    prompt = f"""You are a helpful assistant that generates furniture store item data. Generate 10 furniture store items. Each record should include the following fields: item_id, item_name, item_description, brand, manufacturer_address, prices, categories, user_reviews, notes. Ensure variety in the data and realistic values.
+    per_shard = -(-total // shards)  # Round up so the shards cover the total
+    prompt = f"""You are a helpful assistant that generates furniture store item data. Generate {per_shard} furniture store items. Each record should include the following fields: item_id, item_name, item_description, brand, manufacturer_address, prices, categories, user_reviews, notes. Ensure variety in the data and realistic values.
 
-    {parser.get_format_instructions()}"""
+    {FORMAT_INSTRUCTIONS}"""
 
     # Log progress to console
-    print("Generating synthetic data...")
-
-    # Send prompt to AI and get response
-    response = await llm.ainvoke(prompt)
+    print(f"Generating synthetic data ({shards} parallel requests)...")
+
+    # Limit concurrent Gemini requests to stay within the rate limit
+    semaphore = asyncio.Semaphore(GENERATION_CONCURRENCY)
+
+    async def generate_shard(llm):
+        async with semaphore:
+            return await llm.ainvoke(prompt)
+
+    # Send the prompts to AI in parallel (retrying rate-limited ones) and collect the responses
+    responses = await asyncio.gather(
+        # Rotate through the API keys round-robin
+        *(with_backoff(lambda llm=LLMS[i % len(LLMS)]: generate_shard(llm)) for i in range(shards)),
+        return_exceptions=True
+    )
+
+    # Parse each AI response into structured Item objects, skipping failed ones
+    items: List[Item] = []
+    for response in responses:
+        if isinstance(response, Exception):
+            print(f"Error generating items: {response}")
+            continue
+        try:
+            items.extend(ItemList.model_validate(orjson.loads(strip_code_fence(response.content))).items)
+        except Exception as e:
+            print(f"Error parsing AI response: {e}")
 
-    # Parse AI response into structured list of Item objects
-    try:
-        parsed_data = parser.parse(response.content)
-        return parsed_data.items
-    except Exception as e:
-        print(f"Error parsing AI response: {e}")
-        # If parsing fails, return empty list or handle gracefully
-        return []
+    return items[:total]
 
-async def create_item_summary(item: Item) -> str:
+def create_item_summary(item: Item) -> str:
     """Function to create a searchable text summary from furniture item data"""
-    # Extract manufacturer country information
-    manufacturer_details = f"Made in {item.manufacturer_address.country}"
-    
-    # Join all categories into comma-separated string
-    categories = ", ".join(item.categories)
-    
-    # Convert user reviews list into readable text format
-    user_reviews = " ".join([
-        f"Rated {review.rating} on {review.review_date}: {review.comment}"
-        for review in item.user_reviews
-    ])
-    
-    # Create basic item information string
-    basic_info = f"{item.item_name} {item.item_description} from the brand {item.brand}"
-    
-    # Format pricing information
-    price = f"At full price it costs: {item.prices.full_price} USD, On sale it costs: {item.prices.sale_price} USD"
-    
-    # Get additional notes
-    notes = item.notes
-
-    # Combine all information into comprehensive summary for vector search
-    summary = f"{basic_info}. Manufacturer: {manufacturer_details}. Categories: {categories}. Reviews: {user_reviews}. Price: {price}. Notes: {notes}"
-
-    return summary
-
-async def seed_database() -> None:
+    # Build the summary for vector search in a single join over its fragments:
+    # basic item info, manufacturer country, categories, user reviews, pricing and notes
+    return "".join((
+        item.item_name, " ", item.item_description, " from the brand ", item.brand,
+        ". Manufacturer: Made in ", item.manufacturer_address.country,
+        ". Categories: ", ", ".join(item.categories),
+        ". Reviews: ", " ".join(
+            f"Rated {review.rating} on {review.review_date}: {review.comment}"
+            for review in item.user_reviews
+        ),
+        ". Price: At full price it costs: ", str(item.prices.full_price),
+        " USD, On sale it costs: ", str(item.prices.sale_price), " USD",
+        ". Notes: ", item.notes,
+    ))
+
+async def seed_database(client: AsyncIOMotorClient) -> None:
     """Main function to populate database with AI-generated furniture data"""
     try:
         # Test connection to MongoDB Atlas
         await client.admin.command("ping")
         print("You successfully connected to MongoDB!")
 
-        # Setup database and collection
-        await setup_database_and_collection()
-        
-        # Create vector search index
-        await create_vector_search_index()
-
         # Get reference to specific database
         db = client["inventory_database"]
         collection = db["items"]
 
-        # Clear existing data from collection (fresh start)
-        delete_result = await collection.delete_many({})
-        print(f"Cleared {delete_result.deleted_count} existing documents from items collection")
-        
-        # Generate new synthetic furniture data using AI
-        synthetic_data = await generate_synthetic_data()
+        # Prepare the collection while Gemini generates the new synthetic furniture data;
+        # the Atlas round-trips are hidden behind the much slower LLM calls
+        bootstrap = asyncio.create_task(bootstrap_collection(client))
+        data_task = asyncio.create_task(generate_synthetic_data())
+        _, synthetic_data = await asyncio.gather(bootstrap, data_task)
         
         if not synthetic_data:
             print("No synthetic data generated. Exiting.")
@@ -209,46 +359,43 @@ async def seed_database() -> None:
 
         print(f"Generated {len(synthetic_data)} synthetic items")
 
-        # Process each item: create summary and prepare for vector storage
-        records_with_summaries = []
-        for record in synthetic_data:
-            summary = await create_item_summary(record)
-            records_with_summaries.append({
-                "page_content": summary,
-                "metadata": record.dict()
-            })
-        
-        # Store each record with vector embeddings in MongoDB
-        for i, record in enumerate(records_with_summaries):
-            try:
-                print(f"Processing record {i+1}/{len(records_with_summaries)}")
-                
-                # Convert the record to the format expected by MongoDBAtlasVectorSearch
-                from langchain_core.documents import Document
-                doc = Document(
-                    page_content=record["page_content"],
-                    metadata=record["metadata"]
-                )
-                
-                # Create vector embeddings and store in MongoDB Atlas using Gemini
-                vector_store = MongoDBAtlasVectorSearch.from_documents(
-                    documents=[doc],                                    # Array containing single record
-                    embedding=GoogleGenerativeAIEmbeddings(             # Google embedding model
-                        google_api_key=os.getenv("GOOGLE_API_KEY"),     # Google API key
-                        model="text-embedding-004",                     # Google's standard embedding model (768 dimensions)
-                    ),
-                    collection=collection,                              # MongoDB collection reference
-                    index_name="vector_index",                         # Name of vector search index
-                    text_key="embedding_text",                         # Field name for searchable text
-                    embedding_key="embedding",                         # Field name for vector embeddings
-                )
-
-                # Log progress for each successfully processed item
-                print(f"Successfully processed & saved record: {record['metadata']['item_id']}")
-                
-            except Exception as record_error:
-                print(f"Error processing record {record['metadata'].get('item_id', 'unknown')}: {record_error}")
-                continue
+        # Create a searchable summary for each item
+        summaries = [create_item_summary(record) for record in synthetic_data]
+
+        # Limit how many embed + insert batches are in flight so Atlas isn't oversubscribed
+        semaphore = asyncio.Semaphore(INSERT_CONCURRENCY)
+
+        async def embed_and_insert(records: List[Item], texts: List[str], embeddings) -> int:
+            async with semaphore:
+                # Create vector embeddings for the batch without blocking the event loop
+                vectors = await with_backoff(lambda: embeddings.aembed_documents(texts))
+
+                # Build the MongoDB documents: item fields plus searchable text and its embedding
+                docs = [
+                    {
+                        **record.model_dump(),                  # Pydantic v2 dump, once per record
+                        "embedding_text": summary,              # Field name for searchable text
+                        "embedding": vector,                    # Field name for vector embeddings
+                    }
+                    for record, summary, vector in zip(records, texts, vectors)
+                ]
+
+                # Unordered bulk insert lets the server apply the batch in parallel
+                insert_result = await collection.insert_many(docs, ordered=False)
+                return len(insert_result.inserted_ids)
+
+        # Embed and store the records in batches of EMBED_BATCH
+        print(f"Embedding {len(summaries)} records...")
+        # Each batch uses the next API key round-robin
+        inserted = await asyncio.gather(*(
+            embed_and_insert(
+                synthetic_data[i:i + EMBED_BATCH],
+                summaries[i:i + EMBED_BATCH],
+                EMBEDDERS[batch % len(EMBEDDERS)]
+            )
+            for batch, i in enumerate(range(0, len(summaries), EMBED_BATCH))
+        ))
+        print(f"Successfully processed & saved {sum(inserted)} records")
 
         # Log completion of entire seeding process
         print("Database seeding completed")
@@ -256,10 +403,33 @@ async def seed_database() -> None:
     except Exception as error:
         # Log any errors that occur during database seeding
         print(f"Error seeding database: {error}")
+
+async def main() -> None:
+    """Open the MongoDB connection, seed the database and close the connection again"""
+    # Create MongoDB client instance using connection string from environment variables
+    # SSL configuration for macOS certificate issues
+    client = AsyncIOMotorClient(
+        os.getenv("MONGODB_ATLAS_URI"),
+        tlsCAFile=certifi.where(),
+        maxPoolSize=50,          # Cap connections opened during bulk writes
+        minPoolSize=10,          # Keep warm connections so early operations skip the TLS handshake
+        maxIdleTimeMS=300000,    # Recycle connections idle for more than 5 minutes
+        retryWrites=True,
+    )
+    try:
+        await seed_database(client)
     finally:
-        # Always close database connection when finished (cleanup)
+        # Always close database connection when finished (cleanup), then give the
+        # event loop a turn so the driver's pending cleanup runs before asyncio.run exits
         client.close()
+        await asyncio.sleep(0)
 
 # Execute the database seeding function and handle any errors
 if __name__ == "__main__":
-    asyncio.run(seed_database())
\ No newline at end of file
+    # Run on uvloop when it's available (installed with uvicorn[standard]); Motor is mostly socket IO
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(main())
\ No newline at end of file